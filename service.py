@@ -1,6 +1,7 @@
 import asyncio
 import logging
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import Enum
 from typing import Optional
@@ -28,6 +29,28 @@ class PaymentStatus(str, Enum):
         return self == PaymentStatus.SUCCEEDED
 
 
+# Готовые таблицы значение -> член Enum: dict-поиск заметно дешевле, чем
+# конструктор Enum с try/except, а вызывается на каждый ответ API.
+_STATUS_MAP = {s.value: s for s in PaymentStatus}
+_TIER_MAP = {t.value: t for t in SubscriptionTier}
+
+# Известные значения из вебхуков/ответов API; frozenset-проверка вместо
+# конструктора Enum с исключением на неизвестных значениях.
+_VALID_STATUSES: frozenset = frozenset(_STATUS_MAP)
+_VALID_TIERS: frozenset = frozenset(_TIER_MAP)
+
+
+def _map_status(status: str) -> PaymentStatus:
+    return _STATUS_MAP[status] if status in _VALID_STATUSES else PaymentStatus.PENDING
+
+
+# Цены тарифов не меняются после загрузки настроек: (число, строка для API).
+_TIER_PRICING = {
+    t: (settings.get_tier_price(t.value), str(settings.get_tier_price(t.value)))
+    for t in SubscriptionTier
+}
+
+
 @dataclass
 class PaymentData:
     yookassa_payment_id: str
@@ -38,16 +61,26 @@ class PaymentData:
 
 
 class YooKassaService:
+    def __init__(self) -> None:
+        # Own executor for the blocking SDK so slow YooKassa calls cannot
+        # starve the default loop executor used by the rest of the app.
+        # Размер пула настраивается через YOOKASSA_POOL_SIZE.
+        self._yk_executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, "yookassa_pool_size", 8),
+            thread_name_prefix="yookassa",
+        )
+
     async def create_payment(self, session: AsyncSession, user: User, tier: SubscriptionTier) -> PaymentData:
         """Создание платежа в ЮKassa."""
-        price = settings.get_tier_price(tier.value)
-        idempotence_key = str(uuid.uuid4())
-        description = f"Подписка {tier.value} для пользователя {user.id}"
+        tier_value = tier.value
+        _, price_str = _TIER_PRICING[tier]
+        idempotence_key = uuid.uuid4().hex
+        description = f"Подписка {tier_value} для пользователя {user.id}"
 
         def _create():
             return Payment.create({
                 "amount": {
-                    "value": str(price),
+                    "value": price_str,
                     "currency": "RUB"
                 },
                 "confirmation": {
@@ -58,16 +91,17 @@ class YooKassaService:
                 "description": description,
                 "metadata": {
                     "user_id": user.id,
-                    "tier": tier.value
+                    "tier": tier_value
                 }
             }, idempotence_key)
 
-        # Выполняем синхронный запрос в отдельном потоке
-        payment_response = await asyncio.to_thread(_create)
+        # Выполняем синхронный запрос в выделенном пуле потоков
+        loop = asyncio.get_running_loop()
+        payment_response = await loop.run_in_executor(self._yk_executor, _create)
 
         return PaymentData(
             yookassa_payment_id=payment_response.id,
-            status=PaymentStatus(payment_response.status),
+            status=_map_status(payment_response.status),
             subscription_tier=tier,
             confirmation_url=payment_response.confirmation.confirmation_url,
             amount=float(payment_response.amount.value)
@@ -78,17 +112,15 @@ class YooKassaService:
         def _find():
             return Payment.find_one(payment_id)
 
-        payment_response = await asyncio.to_thread(_find)
+        loop = asyncio.get_running_loop()
+        payment_response = await loop.run_in_executor(self._yk_executor, _find)
         
         tier_str = payment_response.metadata.get("tier", "free")
-        try:
-            tier = SubscriptionTier(tier_str)
-        except ValueError:
-            tier = SubscriptionTier.FREE
+        tier = _TIER_MAP[tier_str] if tier_str in _VALID_TIERS else SubscriptionTier.FREE
 
         return PaymentData(
             yookassa_payment_id=payment_response.id,
-            status=PaymentStatus(payment_response.status),
+            status=_map_status(payment_response.status),
             subscription_tier=tier,
             amount=float(payment_response.amount.value)
         )
\ No newline at end of file
@@ -1,15 +1,18 @@
 import asyncio
+import copy
 import hashlib
 import hmac
-import json
 import logging
+import time
 from datetime import datetime, timezone
+from functools import lru_cache
 from typing import Optional
 from uuid import uuid4
 
+import aiohttp
+import orjson
 from sqlalchemy import select, update
 from sqlalchemy.ext.asyncio import AsyncSession
-from yookassa import Configuration, Payment as YooPayment
 
 from config import settings
 from models import Payment, PaymentStatus, SubscriptionTier, User
@@ -17,65 +20,189 @@ from services import UserService
 
 logger = logging.getLogger(__name__)
 
+_YOOKASSA_API_URL = "https://api.yookassa.ru"
+
+# YooKassa notifications are ~1-2 KiB; anything bigger is garbage and not
+# worth the HMAC CPU. Overridable via settings for paranoid deployments.
+_MAX_WEBHOOK_BYTES = getattr(settings, "yookassa_max_webhook_bytes", 64 * 1024)
+
+# Shared HTTP session for all YooKassa API calls: keep-alive connections and
+# no per-payment worker thread, unlike the blocking SDK behind to_thread.
+_http_session: Optional[aiohttp.ClientSession] = None
+
+
+def _get_http_session() -> aiohttp.ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            base_url=_YOOKASSA_API_URL,
+            auth=aiohttp.BasicAuth(settings.yookassa_shop_id, settings.yookassa_secret_key),
+            connector=aiohttp.TCPConnector(limit=200, keepalive_timeout=60),
+        )
+    return _http_session
+
+
+# Terminal payments never change status again; YooKassa redelivers webhooks
+# aggressively, so cache them in-process to skip the DB on retries.
+_TERMINAL_STATUSES = (PaymentStatus.SUCCEEDED, PaymentStatus.CANCELED)
+_TERMINAL_CACHE_TTL = 3600.0
+_TERMINAL_CACHE_MAXSIZE = 10_000
+
+_WEBHOOK_QUEUE_MAXSIZE = 10_000
+_WEBHOOK_BATCH_SIZE = 100
+
+# Coarse "now" for processed_at stamps: a webhook batch calls this many
+# times back-to-back and tz-aware datetime.now is comparatively expensive,
+# so reuse one value within a 10 ms window.
+_NOW_CACHE_WINDOW = 0.01
+_now_cache: tuple[float, datetime] = (0.0, datetime.min.replace(tzinfo=timezone.utc))
+
+
+def _coarse_utcnow() -> datetime:
+    global _now_cache
+    t = time.monotonic()
+    stamp, now = _now_cache
+    if t - stamp >= _NOW_CACHE_WINDOW:
+        now = datetime.now(timezone.utc)
+        _now_cache = (t, now)
+    return now
+
+
+# Dict lookup is ~10x cheaper than Enum __call__ plus try/except on the
+# happy path; this runs for every API response and webhook.
+_STATUS_MAP = {s.value: s for s in PaymentStatus}
+_STATUS_MAP["waiting_for_capture"] = PaymentStatus.WAITING_FOR_CAPTURE
+
 
 def _map_status(status: str) -> PaymentStatus:
-    try:
-        return PaymentStatus(status)
-    except ValueError:
-        if status == "waiting_for_capture":
-            return PaymentStatus.WAITING_FOR_CAPTURE
-        return PaymentStatus.PENDING
+    return _STATUS_MAP.get(status, PaymentStatus.PENDING)
+
+
+# Tier prices are fixed once settings load; precompute both the integer
+# amount and the "123.00" string the API wants so the hot path is one lookup.
+_TIER_PRICING: dict[SubscriptionTier, tuple[int, str]] = {
+    SubscriptionTier.PRO: (settings.pro_monthly_price, f"{settings.pro_monthly_price:.2f}"),
+    SubscriptionTier.ULTRA: (settings.ultra_monthly_price, f"{settings.ultra_monthly_price:.2f}"),
+}
 
 
 class YooKassaService:
     """YooKassa payment integration with webhook signature verification."""
 
     def __init__(self) -> None:
-        logger.info("Initializing YooKassaService (v3.2 - DEBUG)")
-        Configuration.account_id = settings.yookassa_shop_id
-        Configuration.secret_key = settings.yookassa_secret_key
+        # Encode the webhook secret and key-schedule the HMAC once; per-request
+        # verification copies the initialized state instead of re-running it.
+        self._hmac_key = (settings.yookassa_webhook_secret or "").encode('utf-8')
+        self._hmac_proto = hmac.new(self._hmac_key, None, hashlib.sha256) if self._hmac_key else None
+        # payment_id -> (expiry deadline, Payment); insertion-ordered, oldest
+        # entry evicted first. Only touched from the event loop, no lock needed.
+        self._terminal_cache: dict[str, tuple[float, Payment]] = {}
+        # Per-tier payload skeletons; create_payment shallow-copies one and
+        # fills in the per-call description/metadata. The nested dicts are
+        # shared between copies and must never be mutated in place.
+        self._payment_templates: dict[SubscriptionTier, dict] = {
+            tier: {
+                "amount": {"value": amount_str, "currency": "RUB"},
+                "confirmation": {
+                    "type": "redirect",
+                    "return_url": settings.yookassa_return_url,
+                },
+                "capture": True,
+            }
+            for tier, (_, amount_str) in _TIER_PRICING.items()
+        }
+        # Webhook queue/worker are created by start_webhook_worker(); until
+        # then handle_webhook processes notifications inline as before.
+        self._webhook_queue: Optional["asyncio.Queue[str]"] = None
+        self._webhook_task: Optional["asyncio.Task[None]"] = None
+        self._session_factory = None
+
+    def start_webhook_worker(self, session_factory) -> None:
+        """Start the background consumer that batches webhook processing.
+
+        Args:
+            session_factory: Async sessionmaker used to open a session per payment
+        """
+        if self._webhook_task is not None and not self._webhook_task.done():
+            return
+        self._session_factory = session_factory
+        self._webhook_queue = asyncio.Queue(maxsize=_WEBHOOK_QUEUE_MAXSIZE)
+        self._webhook_task = asyncio.create_task(self._consume_webhooks())
+
+    async def _process_queued(self, payment_id: str) -> None:
+        try:
+            async with self._session_factory() as session:
+                await self.check_payment(session, payment_id)
+                await session.commit()
+        except Exception:
+            logger.exception(f"Error processing queued webhook for payment {payment_id}")
+
+    async def _consume_webhooks(self) -> None:
+        while True:
+            batch = {await self._webhook_queue.get()}
+            # Drain whatever arrived in the meantime; the set coalesces
+            # YooKassa's redeliveries into one check per payment.
+            while len(batch) < _WEBHOOK_BATCH_SIZE:
+                try:
+                    batch.add(self._webhook_queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            await asyncio.gather(*(self._process_queued(pid) for pid in batch))
+
+    def _cache_terminal(self, payment_id: str, payment: Payment) -> None:
+        if len(self._terminal_cache) >= _TERMINAL_CACHE_MAXSIZE:
+            self._terminal_cache.pop(next(iter(self._terminal_cache)))
+        self._terminal_cache[payment_id] = (time.monotonic() + _TERMINAL_CACHE_TTL, payment)
 
     def _get_tier_price_rubles(self, tier: SubscriptionTier) -> int:
         """Get price in RUB for subscription tier."""
-        if tier == SubscriptionTier.PRO:
-            return settings.pro_monthly_price
-        if tier == SubscriptionTier.ULTRA:
-            return settings.ultra_monthly_price
-        return 0
+        return _TIER_PRICING.get(tier, (0, "0.00"))[0]
 
-    def verify_webhook_signature(self, payload: dict, signature: str) -> bool:
+    def verify_webhook_signature(self, raw_body: bytes, signature: str) -> bool:
         """Verify YooKassa webhook signature for security.
-        
+
         Args:
-            payload: Webhook payload as dict
+            raw_body: Raw webhook request body, exactly as received
             signature: Signature from X-Signature header
-            
+
         Returns:
             True if signature is valid, False otherwise
         """
-        if not settings.yookassa_webhook_secret:
+        if self._hmac_proto is None:
             logger.warning("YooKassa webhook secret not configured, skipping verification")
             return True  # Allow if not configured (development mode)
 
+        # Bound worst-case CPU before any hashing: reject oversized bodies
+        # and signatures that cannot possibly be a SHA-256 hex digest.
+        if len(raw_body) > _MAX_WEBHOOK_BYTES:
+            logger.warning("Webhook body too large (%d bytes), rejecting", len(raw_body))
+            return False
+        if len(signature) != 64:
+            return False
+
         try:
             # YooKassa uses HMAC-SHA256 for webhook signatures
             # Format: hmac_sha256(webhook_secret, notification_body)
-            notification_body = json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
-            
-            expected_signature = hmac.new(
-                settings.yookassa_webhook_secret.encode('utf-8'),
-                notification_body.encode('utf-8'),
-                hashlib.sha256
-            ).hexdigest()
-
-            is_valid = hmac.compare_digest(expected_signature, signature)
-            
+            # HMAC the raw bytes directly: re-serializing a parsed dict will
+            # almost never byte-match the body YooKassa actually signed.
+            try:
+                sig_bytes = bytes.fromhex(signature)
+            except ValueError:
+                logger.warning("Webhook signature is not valid hex")
+                return False
+
+            h = self._hmac_proto.copy()
+            h.update(raw_body)
+            # Compare the 32 raw digest bytes; skips hex formatting and
+            # halves the constant-time comparison work.
+            is_valid = hmac.compare_digest(h.digest(), sig_bytes)
+
             if not is_valid:
                 logger.warning(
                     "Invalid webhook signature",
-                    extra={"expected": expected_signature[:16], "received": signature[:16]}
+                    extra={"received": signature[:16]}
                 )
-            
+
             return is_valid
 
         except Exception as exc:
@@ -88,29 +215,29 @@ class YooKassaService:
         user: User,
         tier: SubscriptionTier,
     ) -> Payment:
-        amount_rubles = self._get_tier_price_rubles(tier)
-        description = f"Подписка {tier.value.capitalize()} для пользователя {user.id}"
+        tier_value = tier.value
+        amount_rubles = _TIER_PRICING.get(tier, (0, "0.00"))[0]
+        description = f"Подписка {tier_value.capitalize()} для пользователя {user.id}"
 
         if amount_rubles <= 0:
-            raise ValueError(f"Invalid amount for tier {tier.value}")
-
-        payload = {
-            "amount": {"value": f"{amount_rubles:.2f}", "currency": "RUB"},
-            "confirmation": {
-                "type": "redirect",
-                "return_url": settings.yookassa_return_url,
-            },
-            "capture": True,
-            "description": description,
-            "metadata": {
-                "user_id": str(user.id),
-                "tier": tier.value,
-            },
-        }
+            raise ValueError(f"Invalid amount for tier {tier_value}")
+
+        payload = copy.copy(self._payment_templates[tier])
+        payload["description"] = description
+        payload["metadata"] = {"user_id": str(user.id), "tier": tier_value}
 
         try:
-            idempotence_key = str(uuid4())
-            response = await asyncio.to_thread(YooPayment.create, payload, idempotence_key)
+            idempotence_key = uuid4().hex
+            async with _get_http_session().post(
+                "/v3/payments",
+                data=orjson.dumps(payload),
+                headers={
+                    "Idempotence-Key": idempotence_key,
+                    "Content-Type": "application/json",
+                },
+            ) as resp:
+                resp.raise_for_status()
+                response = orjson.loads(await resp.read())
         except Exception:
             logger.exception("Failed to create YooKassa payment")
             raise
@@ -118,12 +245,12 @@ class YooKassaService:
         # Store amount in kopecks for consistency with payment records
         payment = Payment(
             user_id=user.id,
-            yookassa_payment_id=response.id,
-            subscription_tier=tier.value,
+            yookassa_payment_id=response["id"],
+            subscription_tier=tier_value,
             amount=amount_rubles * 100,  # Convert to kopecks for storage
-            status=_map_status(response.status),
+            status=_map_status(response["status"]),
             description=description,
-            confirmation_url=response.confirmation.confirmation_url,
+            confirmation_url=(response.get("confirmation") or {}).get("confirmation_url"),
         )
 
         session.add(payment)
@@ -135,64 +262,101 @@ class YooKassaService:
         session: AsyncSession,
         payment_id: str,
     ) -> Payment:
+        cached = self._terminal_cache.get(payment_id)
+        if cached is not None:
+            deadline, cached_payment = cached
+            if time.monotonic() < deadline:
+                return cached_payment
+            del self._terminal_cache[payment_id]
+
+        # Один JOIN вместо двух последовательных запросов Payment + User
         result = await session.execute(
-            select(Payment).where(Payment.yookassa_payment_id == payment_id)
+            select(Payment, User)
+            .outerjoin(User, User.id == Payment.user_id)
+            .where(Payment.yookassa_payment_id == payment_id)
+            .limit(1)
         )
-        payment: Optional[Payment] = result.scalar_one_or_none()
-        if not payment:
+        row = result.one_or_none()
+        if row is None:
             raise ValueError("Payment not found")
+        payment, user = row
 
         # Если платеж уже был успешен, не проверяем API и не начисляем подписку повторно
         if payment.status == PaymentStatus.SUCCEEDED:
+            self._cache_terminal(payment_id, payment)
             return payment
 
         try:
-            response = await asyncio.to_thread(YooPayment.find_one, payment_id)
+            async with _get_http_session().get(f"/v3/payments/{payment_id}") as resp:
+                resp.raise_for_status()
+                response = orjson.loads(await resp.read())
         except Exception:
             logger.exception("Failed to check YooKassa payment")
             raise
 
-        new_status = _map_status(response.status)
+        new_status = _map_status(response["status"])
         
         # Начисляем подписку ТОЛЬКО если статус изменился на SUCCEEDED
         if new_status == PaymentStatus.SUCCEEDED and payment.status != PaymentStatus.SUCCEEDED:
-            user_service = UserService(session)
-            result = await session.execute(select(User).where(User.id == payment.user_id))
-            user = result.scalar_one_or_none()
             if user:
+                user_service = UserService(session)
                 await user_service.upgrade_subscription(user, SubscriptionTier(payment.subscription_tier), duration_days=30)
 
-        payment.status = new_status
-        payment.processed_at = datetime.now(timezone.utc)
-        payment.error_message = None
-        if getattr(response, "cancellation_details", None):
-            payment.error_message = getattr(response.cancellation_details, "reason", None)
+        # Одно UPDATE-выражение вместо ORM-изменений + flush; синхронизация
+        # сессии подтягивает новые значения в уже загруженный объект payment.
+        # Коммитит вызывающая сторона — один раз на весь вебхук.
+        await session.execute(
+            update(Payment)
+            .where(Payment.id == payment.id)
+            .values(
+                status=new_status,
+                processed_at=_coarse_utcnow(),
+                error_message=(response.get("cancellation_details") or {}).get("reason"),
+            )
+            .returning(Payment.id)
+        )
 
-        await session.flush()
+        if new_status in _TERMINAL_STATUSES:
+            self._cache_terminal(payment_id, payment)
         return payment
 
-    async def handle_webhook(self, session: AsyncSession, payload: dict, signature: Optional[str] = None) -> Optional[Payment]:
+    async def handle_webhook(self, session: AsyncSession, raw_body: bytes, signature: Optional[str] = None) -> Optional[Payment]:
         """Handle YooKassa webhook with signature verification.
-        
+
         Args:
             session: Database session
-            payload: Webhook payload
+            raw_body: Raw webhook request body (e.g. ``await request.body()``)
             signature: Optional signature from X-Signature header
-            
+
         Returns:
             Updated Payment object or None
         """
-        logger.info("Processing YooKassa webhook (v3.3 - Fixed)")
-        # Verify signature if provided
-        if signature and not self.verify_webhook_signature(payload, signature):
+        logger.debug("Processing YooKassa webhook")
+        # Verify signature if provided; parse JSON only after it passes
+        if signature and not self.verify_webhook_signature(raw_body, signature):
             logger.error("Webhook signature verification failed, ignoring webhook")
             return None
 
+        try:
+            payload = orjson.loads(raw_body)
+        except ValueError:
+            logger.error("Webhook payload is not valid JSON")
+            return None
+
         event_object = payload.get("object") or {}
         payment_id = event_object.get("id")
         if not payment_id:
             return None
 
+        # With the worker running, acknowledge immediately and let the
+        # consumer batch and deduplicate redelivered notifications.
+        if self._webhook_queue is not None:
+            try:
+                self._webhook_queue.put_nowait(payment_id)
+                return None
+            except asyncio.QueueFull:
+                logger.warning("Webhook queue full, processing inline")
+
         # Securely verify payment status via API instead of trusting webhook payload
         try:
             return await self.check_payment(session, payment_id)
@@ -201,4 +365,14 @@ class YooKassaService:
             return None
 
 
-__all__ = ["YooKassaService"]
+@lru_cache(maxsize=1)
+def get_yookassa_service() -> YooKassaService:
+    """Process-wide YooKassaService instance, e.g. for FastAPI ``Depends``.
+
+    Constructing the service per request would rebuild the HMAC state,
+    terminal cache and webhook queue every time; cache one instance instead.
+    """
+    return YooKassaService()
+
+
+__all__ = ["YooKassaService", "get_yookassa_service"]